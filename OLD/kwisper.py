@@ -1,53 +1,103 @@
+import io
 import os
 import time
 import threading
 import logging
-import tempfile
+import math
+from concurrent.futures import Future, ThreadPoolExecutor
+import httpx
 import sounddevice as sd
+import rtmixer
+import webrtcvad
 import soundfile as sf
 import numpy as np
+from scipy.signal import resample_poly
 from pynput import keyboard
 import rumps
 from openai import OpenAI
 import pyperclip
 import objc
 from Foundation import NSObject, NSThread, NSRunLoop
+from PyObjCTools import AppHelper
 from AppKit import (NSPasteboard, NSStringPboardType,
                     NSWorkspace, NSScreen, NSWindow,
                     NSBackingStoreBuffered, NSBorderlessWindowMask,
                     NSColor, NSFloatingWindowLevel, NSWindowStyleMaskTitled,
                     NSTextField, NSMakeRect, NSCenterTextAlignment,
                     NSFont, NSVisualEffectView, NSVisualEffectBlendingModeBehindWindow,
-                    NSVisualEffectMaterialHUDWindow, NSApplication)
+                    NSVisualEffectMaterialHUDWindow, NSApplication,
+                    NSAttributedString, NSMutableParagraphStyle,
+                    NSFontAttributeName, NSForegroundColorAttributeName,
+                    NSParagraphStyleAttributeName)
+from Quartz import (CGEventCreateKeyboardEvent, CGEventSetFlags, CGEventPost,
+                    kCGEventFlagMaskCommand, kCGHIDEventTap)
 import yaml
 
+from opt_tap_sm import (OptTapStateMachine, PRESS, RELEASE,
+                        START_RECORDING, STOP_AND_TRANSCRIBE)
+
 
 class KwisperApp(rumps.App):
     def __init__(self, config):
         super().__init__("🎤", quit_button=None)
         logging.basicConfig(level=logging.INFO,
                             format='%(asctime)s - %(levelname)s - %(message)s')
-        self.is_transcribing = False
+        # (Future of transcript text, target app) for each dictation, in recording order
+        self._pending_batch = []
+        self._batch_lock = threading.Lock()
+        self._batch_generation = 0  # bumped by Escape to drop queued pastes
+        # Pastes run one at a time, in order, off the keyboard listener thread
+        self._paste_executor = ThreadPoolExecutor(max_workers=1)
 
         # Load config settings
         self.config = config
         self.model = self.config["whisper"]["model"]
         self.language = self.config["whisper"]["language"]
         self.prompt = self.config["whisper"].get("prompt", "")
+        self.backend = self.config["whisper"].get("backend", "openai")
+        self.local_model = self.config["whisper"].get("local_model", "small")
         self.restore_clipboard = self.config.get("clipboard", {}).get("restore_previous", True)
         self.previous_clipboard_content = None
 
+        # Cocoa singletons, looked up once instead of on every dictation
+        self._pasteboard = NSPasteboard.generalPasteboard()
+        self._workspace = NSWorkspace.sharedWorkspace()
+        self._nsapp = NSApplication.sharedApplication()
+
         self.recording = False
-        self.audio_data = []
-        self.sample_rate = 44100
-        self.client = OpenAI()
+        self.upload_sample_rate = 16000  # Whisper works on 16 kHz audio
+        self.vad_aggressiveness = 1  # webrtcvad mode, 0 (least) to 3 (most aggressive)
+        self.vad_padding = 0.2  # seconds of audio kept around detected speech
+        self.sample_rate = self._pick_sample_rate()
+        self.max_recording_seconds = 600
+        self.min_recording_seconds = 0.5  # shorter recordings are not transcribed
+        self._audio_buf = np.empty(self.sample_rate * self.max_recording_seconds,
+                                   dtype=np.float32)
+        self._write_idx = 0
+        self.ringbuffer_seconds = 2  # capture headroom between drains
+        self.drain_interval = 0.5  # seconds between ring buffer drains
+        self._stop_event = threading.Event()
+        self._capture = None  # Future resolving to the last recording's samples
+        self._local_model = None
+        if self.backend == "local":
+            # Transcribe on-device with faster-whisper, no network round trip
+            from faster_whisper import BatchedInferencePipeline, WhisperModel
+            self._local_model = BatchedInferencePipeline(
+                model=WhisperModel(self.local_model, device="auto", compute_type="int8"))
+        else:
+            # Keep one HTTP/2 connection alive between dictations
+            self._http_client = httpx.Client(
+                # Long recordings can take minutes to transcribe; only bound the rest
+                http2=True, timeout=httpx.Timeout(30.0, read=600.0),
+                limits=httpx.Limits(max_keepalive_connections=2, keepalive_expiry=600))
+            self.client = OpenAI(http_client=self._http_client)
+            threading.Thread(target=self._warm_connection, daemon=True).start()
         self.recording_thread = None
-        self.opt_pressed = False
-        self.last_opt_press_time = 0
-        self.last_opt_event_time = 0
-        self.waiting_for_second_tap = False
         self.opt_tap_threshold = 1.0  # seconds to wait for second tap
         self.min_event_interval = 0.05  # minimum time between key events
+        self._opt_tap = OptTapStateMachine(int(self.opt_tap_threshold * 1e9),
+                                           int(self.min_event_interval * 1e9))
+        self.v_keycode = 9  # kVK_ANSI_V
         self.previous_window = None
         self.recording_window = None
         self.status_label = None
@@ -57,6 +107,17 @@ class KwisperApp(rumps.App):
         self._setup_window_content()
         self.recording_window.orderOut_(None)  # hide initially
 
+    def _pick_sample_rate(self):
+        # Record at Whisper's rate directly; fall back to 48 kHz and resample later
+        try:
+            sd.check_input_settings(channels=1, dtype='float32',
+                                    samplerate=self.upload_sample_rate)
+            return self.upload_sample_rate
+        except sd.PortAudioError:
+            logging.warning(
+                f"Input device does not support {self.upload_sample_rate} Hz, recording at 48000 Hz")
+            return 48000
+
     def create_window(self):
         screen = NSScreen.mainScreen()
         screen_rect = screen.frame()
@@ -93,8 +154,20 @@ class KwisperApp(rumps.App):
         label.setFont_(NSFont.boldSystemFontOfSize_(16))
         label.setAlignment_(NSCenterTextAlignment)
         self.status_label = label
-        label.setStringValue_(
-            "🎙️ KWisper Recording...\nRelease option to stop")
+
+        # Build both status texts once and swap them in on state changes
+        paragraph = NSMutableParagraphStyle.alloc().init()
+        paragraph.setAlignment_(NSCenterTextAlignment)
+        attributes = {
+            NSFontAttributeName: NSFont.boldSystemFontOfSize_(16),
+            NSForegroundColorAttributeName: NSColor.whiteColor(),
+            NSParagraphStyleAttributeName: paragraph,
+        }
+        self._rec_text = NSAttributedString.alloc().initWithString_attributes_(
+            "🎙️ KWisper Recording...\nRelease option to stop", attributes)
+        self._trans_text = NSAttributedString.alloc().initWithString_attributes_(
+            "✨ KWisper Transcribing...", attributes)
+        label.setAttributedStringValue_(self._rec_text)
 
         # Add label to content view
         content_view.addSubview_(label)
@@ -106,6 +179,10 @@ class KwisperApp(rumps.App):
         self.recording_window.setHasShadow_(True)
 
     def setup_keyboard_listener(self):
+        # Option can also arrive as a raw KeyCode with virtual key 58
+        self._opt_keys = frozenset({keyboard.Key.alt, keyboard.Key.alt_l,
+                                    keyboard.Key.alt_r, keyboard.Key.alt_gr,
+                                    keyboard.KeyCode.from_vk(58)})
         self.keyboard_listener = keyboard.Listener(
             on_press=self.on_press,
             on_release=self.on_release
@@ -114,186 +191,284 @@ class KwisperApp(rumps.App):
 
     def on_press(self, key):
         try:
-            key_str = str(key)
-            current_time = time.time()
-
             # Handle Escape key during recording or transcribing
-            if key == keyboard.Key.esc and (self.recording or self.is_transcribing):
-                if self.recording:
-                    self.stop_recording()
-                self.is_transcribing = False
-                self.recording_window.orderOut_(None)
-                return
-
-            # Process Option key events
-            if '<58>' not in key_str and 'Key.alt' not in key_str:
+            if key is keyboard.Key.esc:
+                if self.recording or self._pending_batch:
+                    if self.recording:
+                        self.stop_recording()
+                    self._cancel_pending()
+                    self.recording_window.orderOut_(None)
                 return
 
-            # Prevent duplicate events
-            if current_time - self.last_opt_event_time < self.min_event_interval:
+            # Bail out early for ordinary typing without converting the key to a string
+            if key not in self._opt_keys:
                 return
 
-            self.last_opt_event_time = current_time
-
-            if not self.opt_pressed:
-                if not self.waiting_for_second_tap:
-                    # First tap
-                    self.last_opt_press_time = current_time
-                    self.waiting_for_second_tap = True
-                else:
-                    # Check second tap
-                    time_since_last = current_time - self.last_opt_press_time
-                    if time_since_last <= self.opt_tap_threshold:
-                        if not self.recording:
-                            self.start_recording()
-                    else:
-                        # New first tap
-                        self.last_opt_press_time = current_time
-                        self.waiting_for_second_tap = True
-
-                self.opt_pressed = True
+            action = self._opt_tap.update(PRESS, time.monotonic_ns(), self.recording)
+            if action == START_RECORDING:
+                self.start_recording()
         except Exception as e:
             logging.error(f"Error in on_press: {str(e)}")
 
     def on_release(self, key):
+        if key not in self._opt_keys:
+            return
         try:
-            key_str = str(key)
-            current_time = time.time()
-
-            # Process Option key events
-            if '<58>' not in key_str and 'Key.alt' not in key_str:
-                return
-
-            # Prevent duplicate events
-            if current_time - self.last_opt_event_time < self.min_event_interval:
-                return
-
-            self.last_opt_event_time = current_time
-
-            if self.opt_pressed:
-                self.opt_pressed = False
-
-                if self.recording:
-                    self.stop_recording()
-                    self.transcribe_and_paste()
-                elif self.waiting_for_second_tap:
-                    time_since_last = current_time - self.last_opt_press_time
-                    if time_since_last > self.opt_tap_threshold:
-                        self.waiting_for_second_tap = False
+            action = self._opt_tap.update(RELEASE, time.monotonic_ns(), self.recording)
+            if action == STOP_AND_TRANSCRIBE:
+                self.stop_recording()
+                self.transcribe_and_paste()
         except Exception as e:
             logging.error(f"Error in on_release: {str(e)}")
 
     def start_recording(self):
+        # The previous capture thread still owns the shared buffer until its stream
+        # closes; don't block the keyboard listener waiting for it
+        if self.recording_thread and self.recording_thread.is_alive():
+            logging.warning("Previous recording is still closing, not starting a new one")
+            return
+
         self.recording = True
-        self.audio_data = []
+        self._write_idx = 0
         self.title = "🔴"
         logging.info("Started recording")
 
-        # Store the current active window
-        self.previous_window = NSWorkspace.sharedWorkspace().activeApplication()
+        # Store the current active window, unless it is KWisper itself
+        active_app = self._workspace.activeApplication()
+        if active_app['NSApplicationProcessIdentifier'] != os.getpid():
+            self.previous_window = active_app
 
         # Show and activate recording window
-        NSApp = NSApplication.sharedApplication()
-        NSApp.activateIgnoringOtherApps_(True)
+        self._nsapp.activateIgnoringOtherApps_(True)
         self.recording_window.setLevel_(NSFloatingWindowLevel)
         self.recording_window.makeKeyAndOrderFront_(None)
         self.recording_window.orderFrontRegardless()
-        self.status_label.setStringValue_(
-            "🎙️ KWisper Recording...\nRelease option to stop")
+        self.status_label.setAttributedStringValue_(self._rec_text)
 
-        def record_audio():
-            with sd.InputStream(samplerate=self.sample_rate, channels=1, callback=self.audio_callback):
-                while self.recording:
-                    time.sleep(0.1)
+        # Capture runs in rtmixer's C callback; Python only drains the ring buffer
+        frames = self.sample_rate * self.ringbuffer_seconds
+        ringbuffer = rtmixer.RingBuffer(elementsize=self._audio_buf.itemsize,
+                                        size=1 << (frames - 1).bit_length())
+
+        capture = Future()
+        self._capture = capture
 
+        def record_audio():
+            try:
+                # rtmixer always records float32, it takes no dtype argument
+                with rtmixer.Recorder(samplerate=self.sample_rate, channels=1,
+                                      blocksize=0) as recorder:
+                    recorder.record_ringbuffer(ringbuffer)
+                    while not self._stop_event.wait(self.drain_interval):
+                        self._drain_ringbuffer(ringbuffer)
+                self._drain_ringbuffer(ringbuffer)
+                # Copy out of the shared buffer so a new recording can't overwrite it
+                capture.set_result(self._audio_buf[:self._write_idx].copy())
+            except Exception as e:
+                logging.error(f"Error in record_audio: {str(e)}")
+                capture.set_exception(e)
+
+        self._stop_event.clear()
         self.recording_thread = threading.Thread(target=record_audio)
         self.recording_thread.start()
 
-    def audio_callback(self, indata, frames, time_info, status):
-        if self.recording:
-            self.audio_data.append(indata.copy())
+    def _drain_ringbuffer(self, ringbuffer):
+        available = ringbuffer.read_available
+        if not available:
+            return
+        start = self._write_idx
+        end = min(start + available, len(self._audio_buf))
+        if end == start:
+            # Buffer full, discard anything recorded past the limit
+            ringbuffer.advance_read_index(available)
+            return
+        self._write_idx = start + ringbuffer.readinto(self._audio_buf[start:end])
 
     def stop_recording(self):
         self.recording = False
+        self._stop_event.set()
         self.title = "🎤"
         logging.info("Stopped recording")
 
         # Return to previous window
         if self.previous_window:
-            NSWorkspace.sharedWorkspace().launchApplication_(
+            self._workspace.launchApplication_(
                 self.previous_window['NSApplicationName']
             )
 
-        if self.recording_thread:
-            self.recording_thread.join()
-
     def transcribe_and_paste(self):
-        if not self.audio_data:
-            # Hide the window if nothing recorded
-            self.recording_window.orderOut_(None)
-            return
+        capture = self._capture
+
+        # Each dictation pastes into the app that was focused when it was recorded
+        result = Future()
+        with self._batch_lock:
+            self._pending_batch.append((result, self.previous_window))
 
         def transcribe_work():
-            self.is_transcribing = True
-            audio_data = np.concatenate(self.audio_data, axis=0)
-
-            # Save to temporary WAV file
-            with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as temp_audio:
-                sf.write(temp_audio.name, audio_data, self.sample_rate)
-
-                try:
-                    # Use config-provided model, language, and prompt
-                    with open(temp_audio.name, 'rb') as audio_file:
-                        transcript = self.client.audio.transcriptions.create(
-                            model=self.model,
-                            file=audio_file,
-                            language=self.language,
-                            prompt=self.prompt
-                        )
-
-                    if transcript.text and self.is_transcribing:
-                        text = transcript.text.strip()
-                        logging.info("Transcription completed")
-
-                        def complete_transcription():
-                            try:
-                                # Hide the window
-                                self.recording_window.orderOut_(None)
-
-                                # Switch back to previous app and paste
-                                if self.previous_window:
-                                    NSWorkspace.sharedWorkspace().launchApplication_(
-                                        self.previous_window['NSApplicationName']
-                                    )
-                                    time.sleep(0.3)
-
-                                self.paste_text(text)
-                                logging.info(
-                                    "Transcription completed and pasted")
-
-                            except Exception as e:
-                                logging.error(
-                                    f"Error in complete_transcription: {str(e)}")
-
-                        complete_transcription()
-
-                finally:
-                    os.unlink(temp_audio.name)
-                    self.is_transcribing = False
-
-        # Show status before starting transcription
-        self.recording_window.orderFrontRegardless()
-        self.recording_window.makeKeyAndOrderFront_(None)
-        self.status_label.setStringValue_("✨ KWisper Transcribing...")
-        NSApplication.sharedApplication().activateIgnoringOtherApps_(True)
+            text = None
+            try:
+                text = self._transcribe_capture(capture)
+            except Exception as e:
+                logging.error(f"Error in transcribe_work: {str(e)}")
+            finally:
+                result.set_result(text)
+                self._flush_batch()
+
+        # Start transcription in background; dictations in quick succession
+        # upload in parallel over the shared keep-alive connection
+        threading.Thread(target=transcribe_work).start()
+
+    def _transcribe_capture(self, capture):
+        # Only the samples are needed; the stream can finish closing meanwhile
+        audio_data = capture.result(timeout=1.0)
+
+        # Skip empty recordings and accidental taps, nothing worth a round trip
+        duration = len(audio_data) / self.sample_rate
+        if duration < self.min_recording_seconds:
+            logging.info(f"Skipping transcription of {duration:.2f}s recording")
+            return None
+
+        # Cocoa UI must be updated from the main thread
+        AppHelper.callAfter(self._show_transcribing)
         logging.info("Starting transcription")
 
-        # Start transcription in background
-        threading.Thread(target=transcribe_work).start()
+        if self._local_model is not None:
+            return self._transcribe_local(audio_data)
+
+        # The startup warm-up keeps a pooled connection, so upload right away
+        return self._upload(self._encode_wav(audio_data))
+
+    def _show_transcribing(self):
+        # Show the floating window without activating KWisper, so the target
+        # app stays in front while uploads are in flight
+        self.recording_window.orderFrontRegardless()
+        self.status_label.setAttributedStringValue_(self._trans_text)
+
+    def _encode_wav(self, audio_data):
+        # numpy and soundfile release the GIL here; keep Cocoa calls out of this step
+        buf = io.BytesIO()
+        pcm = self._trim_silence(self._to_upload_pcm(audio_data))
+        sf.write(buf, pcm, self.upload_sample_rate,
+                 format='WAV', subtype='PCM_16')
+        return buf.getvalue()
+
+    def _upload(self, wav_bytes):
+        # Use config-provided model, language, and prompt
+        transcript = self.client.audio.transcriptions.create(
+            model=self.model,
+            file=('audio.wav', wav_bytes, 'audio/wav'),
+            language=self.language,
+            prompt=self.prompt
+        )
+        logging.info("Transcription completed")
+        return transcript.text.strip() if transcript.text else None
+
+    def _transcribe_local(self, audio_data):
+        # faster-whisper takes the float32 samples directly, no WAV encoding needed
+        segments, _ = self._local_model.transcribe(
+            self._resample_for_whisper(audio_data).astype(np.float32),
+            language=self.language,
+            initial_prompt=self.prompt or None,
+            beam_size=1
+        )
+        text = "".join(segment.text for segment in segments).strip()
+        logging.info("Transcription completed")
+        return text or None
+
+    def _flush_batch(self):
+        # Paste finished transcriptions in recording order; a later dictation
+        # that finishes first waits for the ones before it
+        with self._batch_lock:
+            ready = []
+            while self._pending_batch and self._pending_batch[0][0].done():
+                ready.append(self._pending_batch.pop(0))
+
+            if not self._pending_batch and not self.recording:
+                AppHelper.callAfter(self.recording_window.orderOut_, None)
+
+            # Submitting under the lock keeps paste order; pasting itself happens
+            # without it so the keyboard listener never waits on a paste
+            for result, target in ready:
+                text = result.result()
+                if text:
+                    self._paste_executor.submit(self._paste_into, target, text,
+                                                self._batch_generation)
+
+    def _cancel_pending(self):
+        # Transcriptions still in flight finish, but their text is dropped
+        with self._batch_lock:
+            self._pending_batch.clear()
+            self._batch_generation += 1
+
+    def _paste_into(self, target, text, generation):
+        if generation != self._batch_generation:
+            return
+        try:
+            # Switch back to the dictation's app and paste
+            if target:
+                app_name = target['NSApplicationName']
+                self._workspace.launchApplication_(app_name)
+                self._wait_frontmost(app_name)
+
+            self.paste_text(text)
+            logging.info("Transcription completed and pasted")
+
+        except Exception as e:
+            logging.error(f"Error in _paste_into: {str(e)}")
+
+    def _wait_frontmost(self, target_name, timeout=0.5):
+        # Paste as soon as the target app is in front instead of sleeping a fixed time
+        for _ in range(int(timeout / 0.01)):
+            # frontmostApplication() can be None while apps are switching
+            frontmost = self._workspace.frontmostApplication()
+            if frontmost is not None and frontmost.localizedName() == target_name:
+                return
+            time.sleep(0.01)
+
+    def _warm_connection(self):
+        # Any response leaves a TLS connection in the pool for the first upload to reuse
+        try:
+            self._http_client.head(str(self.client.base_url))
+        except httpx.HTTPError as e:
+            logging.warning(f"Connection warm-up failed: {str(e)}")
+
+    def _resample_for_whisper(self, audio_data):
+        # Whisper works on 16 kHz audio; only needed when the device couldn't record at it
+        if self.sample_rate == self.upload_sample_rate:
+            return audio_data
+        g = math.gcd(self.upload_sample_rate, self.sample_rate)
+        return resample_poly(audio_data, self.upload_sample_rate // g,
+                             self.sample_rate // g)
+
+    def _to_upload_pcm(self, audio_data):
+        # Quantize to int16 to shrink the upload
+        audio_data = self._resample_for_whisper(audio_data)
+        return (np.clip(audio_data, -1.0, 1.0) * 32767).astype(np.int16)
+
+    def _trim_silence(self, pcm):
+        # Cut leading/trailing silence so Whisper only sees the voiced part
+        vad = webrtcvad.Vad(self.vad_aggressiveness)
+        frame_len = self.upload_sample_rate * 30 // 1000  # webrtcvad takes 30 ms frames
+        n_frames = len(pcm) // frame_len
+
+        def is_voiced(i):
+            frame = pcm[i * frame_len:(i + 1) * frame_len].tobytes()
+            return vad.is_speech(frame, self.upload_sample_rate)
+
+        first = next((i for i in range(n_frames) if is_voiced(i)), None)
+        if first is None:
+            # Nothing detected, upload as-is rather than risk dropping quiet speech
+            return pcm
+        last = next(i for i in reversed(range(first, n_frames)) if is_voiced(i))
+
+        pad = int(self.upload_sample_rate * self.vad_padding)
+        start = max(first * frame_len - pad, 0)
+        end = min((last + 1) * frame_len + pad, len(pcm))
+        return pcm[start:end]
 
     def paste_text(self, text):
-        pasteboard = NSPasteboard.generalPasteboard()
-        
+        pasteboard = self._pasteboard
+
         # Store previous clipboard content if restoration is enabled
         if self.restore_clipboard:
             self.previous_clipboard_content = pasteboard.stringForType_(NSStringPboardType)
@@ -302,18 +477,11 @@ class KwisperApp(rumps.App):
         pasteboard.clearContents()
         pasteboard.setString_forType_(text, NSStringPboardType)
 
-        # Give the pasteboard a moment
-        time.sleep(0.1)
-
-        # Simulate Cmd+V
-        kb = keyboard.Controller()
-        kb.press(keyboard.Key.cmd)
-        time.sleep(0.05)
-        kb.press('v')
-        time.sleep(0.05)
-        kb.release('v')
-        time.sleep(0.05)
-        kb.release(keyboard.Key.cmd)
+        # Simulate Cmd+V as V down/up events carrying the Command flag
+        for key_down in (True, False):
+            event = CGEventCreateKeyboardEvent(None, self.v_keycode, key_down)
+            CGEventSetFlags(event, kCGEventFlagMaskCommand)
+            CGEventPost(kCGHIDEventTap, event)
 
         # Restore previous clipboard content if enabled
         if self.restore_clipboard and self.previous_clipboard_content:
@@ -331,14 +499,14 @@ class KwisperApp(rumps.App):
 
 
 if __name__ == "__main__":
-    if not os.getenv("OPENAI_API_KEY"):
-        print("Error: OPENAI_API_KEY environment variable not set")
-        exit(1)
-
     # Load configuration from YAML
     with open("config.yml", "r") as f:
         cfg = yaml.safe_load(f)
 
+    if cfg["whisper"].get("backend", "openai") != "local" and not os.getenv("OPENAI_API_KEY"):
+        print("Error: OPENAI_API_KEY environment variable not set")
+        exit(1)
+
     app = KwisperApp(cfg)
     app.run()
 
@@ -0,0 +1,69 @@
+"""Option-key double-tap state machine.
+
+Runs on pynput's event tap thread for every Option press/release, so it is
+kept free of pynput and Cocoa objects and fully typed for mypyc:
+
+    mypyc opt_tap_sm.py
+
+The plain Python module is used when no compiled extension is present.
+"""
+from typing import Final
+
+# Events passed to update()
+PRESS: Final = 0
+RELEASE: Final = 1
+
+# Actions returned by update()
+NO_OP: Final = 0
+START_RECORDING: Final = 1
+STOP_AND_TRANSCRIBE: Final = 2
+
+
+class OptTapStateMachine:
+    def __init__(self, tap_threshold_ns: int, min_event_interval_ns: int) -> None:
+        self.tap_threshold_ns = tap_threshold_ns  # time to wait for second tap
+        self.min_event_interval_ns = min_event_interval_ns  # minimum time between key events
+        self.opt_pressed = False
+        self.waiting_for_second_tap = False
+        self.last_press_ns = 0
+        self.last_event_ns = 0
+
+    def update(self, event: int, now_ns: int, recording: bool) -> int:
+        # Prevent duplicate events
+        if now_ns - self.last_event_ns < self.min_event_interval_ns:
+            return NO_OP
+
+        self.last_event_ns = now_ns
+
+        if event == PRESS:
+            return self._on_press(now_ns, recording)
+        return self._on_release(now_ns, recording)
+
+    def _on_press(self, now_ns: int, recording: bool) -> int:
+        if self.opt_pressed:
+            return NO_OP
+
+        self.opt_pressed = True
+        if not self.waiting_for_second_tap:
+            # First tap
+            self.last_press_ns = now_ns
+            self.waiting_for_second_tap = True
+        elif now_ns - self.last_press_ns <= self.tap_threshold_ns:
+            # Second tap
+            if not recording:
+                return START_RECORDING
+        else:
+            # New first tap
+            self.last_press_ns = now_ns
+        return NO_OP
+
+    def _on_release(self, now_ns: int, recording: bool) -> int:
+        if not self.opt_pressed:
+            return NO_OP
+
+        self.opt_pressed = False
+        if recording:
+            return STOP_AND_TRANSCRIBE
+        if self.waiting_for_second_tap and now_ns - self.last_press_ns > self.tap_threshold_ns:
+            self.waiting_for_second_tap = False
+        return NO_OP